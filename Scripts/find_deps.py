@@ -1,85 +1,174 @@
 #!/usr/bin/env python2
 from pisi.db.filesdb import FilesDB
 import pisi.api
-import magic
+import multiprocessing
 import os
 import re
+import stat
+import struct
 import subprocess
-
-valid_dyn = ""
-
-v_dyn = re.compile(r"ELF (64|32)\-bit LSB shared object,")
-v_bin = re.compile(r"ELF (64|32)\-bit LSB executable,")
-shared_lib = re.compile(r".*Shared library: \[(.*)\].*")
-r_path = re.compile(r".*Library rpath: \[(.*)\].*")
-r_soname = re.compile(r".*Library soname: \[(.*)\].*")
-
-def get_soname(path):
-    output = subprocess.check_output("/usr/bin/readelf -d {}".format(path), shell=True)
-
-    for line in output.split("\n"):
-        line = line.strip()
-        g = r_soname.match(line)
-        if g:
-            return g.group(1)
-    return None
-
-def accumulate_dependencies(path, provided, emul32=False):
-    output = subprocess.check_output("/usr/bin/readelf -d {}".format(path), shell=True)
-
-    check_deps = set()
-    r_paths = set()
-
-    valid_libs = set()
-
-    if emul32:
-        valid_libs.update(["/usr/lib32", "/lib32"])
-    else:
-        # Currently on Solus this is the same thing as /usr/lib.
-        valid_libs.update(["/usr/lib64", "/lib64"])
-
-    for line in output.split("\n"):
-        line = line.strip()
-        g = shared_lib.match(line)
-        if g:
-            lib = g.group(1)
-            if lib in provided:
-                print("\nSkipping internally provided so: {}\n".format(lib))
-                continue
-            check_deps.add(lib)
-            continue
-        r = r_path.match(line)
-        if r:
-            r_paths.add(r.group(1))
+import sys
+
+try:
+    from elftools.elf.elffile import ELFFile
+    from elftools.elf.dynamic import DynamicSection
+except ImportError:
+    # No pyelftools available, fall back to parsing readelf(1) output
+    ELFFile = None
+
+_elf_cache = dict()
+
+ELF_MAGIC = b"\x7fELF"
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ET_EXEC = 2
+ET_DYN = 3
+
+shared_lib = re.compile(r"Shared library: \[([^\n]*)\]")
+r_path = re.compile(r"Library rpath: \[([^\n]*)\]")
+r_soname = re.compile(r"Library soname: \[([^\n]*)\]")
+r_file = re.compile(r"^File: (.*)$", re.M)
+
+# Number of paths handed to a single readelf(1) run
+readelf_batch_size = 512
+
+# Never ELF, no need to open them. Numeric suffixes such as .1 are not
+# listed as they would also match versioned libraries like libfoo.so.1
+skip_exts = frozenset([".py", ".h", ".txt", ".md", ".gz", ".xz"])
+
+valid_libs32 = frozenset(["/usr/lib32", "/lib32"])
+# Currently on Solus this is the same thing as /usr/lib.
+valid_libs64 = frozenset(["/usr/lib64", "/lib64"])
+
+def inspect_elf(path):
+    if ELFFile is not None:
+        soname = None
+        libs = set()
+        r_paths = set()
+        with open(path, "rb") as f:
+            elf = ELFFile(f)
+            emul32 = elf.elfclass == 32
+            for section in elf.iter_sections():
+                if not isinstance(section, DynamicSection):
+                    continue
+                for tag in section.iter_tags():
+                    if tag.entry.d_tag == "DT_SONAME":
+                        soname = tag.soname
+                    elif tag.entry.d_tag == "DT_NEEDED":
+                        libs.add(tag.needed)
+                    elif tag.entry.d_tag == "DT_RPATH":
+                        r_paths.add(tag.rpath)
+        return emul32, soname, libs, r_paths
+
+    emul32 = not classify_elf_fast(path)[1]
+    output = subprocess.check_output(["/usr/bin/readelf", "-d", path])
+    return (emul32,) + parse_dynamic_section(output)
+
+def parse_dynamic_section(output):
+    sonames = r_soname.findall(output)
+    soname = sonames[-1] if sonames else None
+    return soname, set(shared_lib.findall(output)), set(r_path.findall(output))
+
+def batch_inspect_elf(paths):
+    ret = dict()
+    for i in range(0, len(paths), readelf_batch_size):
+        chunk = paths[i:i + readelf_batch_size]
+        output = subprocess.check_output(["/usr/bin/readelf", "-d", "--"] + chunk)
+        # readelf only prefixes each dump with "File: <path>" for multiple files
+        if len(chunk) == 1:
+            dumps = zip(chunk, [output])
+        else:
+            split = r_file.split(output)
+            dumps = zip(split[1::2], split[2::2])
+        for path, dump in dumps:
+            emul32 = not classify_elf_fast(path)[1]
+            ret[path] = (emul32,) + parse_dynamic_section(dump)
+    return ret
+
+def accumulate_dependencies(path, libs, r_paths, provided, emul32=False):
+    valid_libs = valid_libs32 if emul32 else valid_libs64
+
+    for lib in libs & provided:
+        print("\nSkipping internally provided so: {}\n".format(lib))
+    check_deps = libs - provided
 
     print("Deps: {}".format(", ".join(check_deps)))
 
     dirname = os.path.dirname(path)
 
-    filter_deps = [x for x in check_deps for y in r_paths if os.path.exists(os.path.join(y, x)) or os.path.exists(os.path.join(dirname, x))]
+    filter_deps = {x for x in check_deps for y in r_paths if os.path.exists(os.path.join(y, x)) or os.path.exists(os.path.join(dirname, x))}
     print("Filtered by rpath: {}".format(", ".join(filter_deps)))
 
     print("Got %d of rpath:" % len(filter_deps))
 
-    ret_deps = filter(lambda s: s not in filter_deps, check_deps)
+    ret_deps = check_deps - filter_deps
     print("Remaining deps: {}".format(", ".join(ret_deps)))
 
     full_paths = [os.path.join(y,x) for x in ret_deps for y in valid_libs if os.path.exists(os.path.join(y,x))]
     print("Full paths is now: {}".format(", ".join(full_paths)))
     return full_paths
 
-def is_dynamic_binary(path):
-    if not os.path.exists(path) or not os.path.isfile(path):
+def classify_elf_fast(path, st=None):
+    if st is None:
+        st = os.lstat(path)
+    # Key on the inode so hardlinked copies are only read once
+    key = (st.st_dev, st.st_ino)
+    if key in _elf_cache:
+        return _elf_cache[key]
+    with open(path, "rb") as f:
+        hdr = bytearray(f.read(18))
+    if len(hdr) < 18 or hdr[:4] != ELF_MAGIC:
+        ret = (False, False, False, None)
+    else:
+        is_64bit = hdr[4] == ELFCLASS64
+        is_little_endian = hdr[5] == ELFDATA2LSB
+        e_type = struct.unpack("<H" if is_little_endian else ">H", bytes(hdr[16:18]))[0]
+        ret = (True, is_64bit, is_little_endian, e_type)
+    _elf_cache[key] = ret
+    return ret
+
+def is_dynamic_binary(path, st=None):
+    if os.path.splitext(path)[1] in skip_exts:
+        return False
+    if st is None:
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+    # Symlinks resolve to a file that is inspected in its own right
+    if not stat.S_ISREG(st.st_mode):
         return False
     try:
-        mg = magic.from_file(path)
-    except Exception, e:
+        is_elf, is_64bit, is_little_endian, e_type = classify_elf_fast(path, st)
+    except (IOError, OSError):
         return False
-    if v_bin.match(mg):
-        return True
-    if v_dyn.match(mg):
-        return True
-    return False
+    return is_elf and is_little_endian and e_type in (ET_EXEC, ET_DYN)
+
+def probe_file(path):
+    if not is_dynamic_binary(path):
+        return None
+    return inspect_elf(path)
+
+def probe_files(paths):
+    # Not worth forking workers for a handful of files
+    if len(paths) < 64 or multiprocessing.cpu_count() < 2:
+        return [probe_file(x) for x in paths]
+    pool = multiprocessing.Pool()
+    try:
+        return pool.map(probe_file, paths, chunksize=32)
+    finally:
+        pool.close()
+        pool.join()
+
+def collect_elf_files(paths):
+    if ELFFile is None:
+        # Amortize the readelf(1) spawns over many files at once
+        return batch_inspect_elf([x for x in paths if is_dynamic_binary(x)])
+    elf_files = dict()
+    for path, info in zip(paths, probe_files(paths)):
+        if info is not None:
+            elf_files[path] = info
+    return elf_files
 
 def clean_path(p):
     if not p[0] == '/':
@@ -91,33 +180,33 @@ def main():
     packages = ["firefox"]
 
     provided = set()
-    want_depends = set()
 
     deps = set()
 
+    candidates = list()
+
     for pkg in packages:
         (stuff,files,repo) = pisi.api.info_name(pkg, True)
 
         for f in files.list:
-            f = clean_path(f.path)
+            candidates.append(clean_path(f.path))
 
-            if not is_dynamic_binary(f):
-                continue
-            soname = get_soname(f)
-            if soname is not None:
-                print("\n\nAdding %s to provided\n\n" % soname)
-                provided.add(soname)
-            want_depends.add(f)
+    want_depends = collect_elf_files(candidates)
+
+    for want in candidates:
+        if want not in want_depends:
+            continue
+        soname = want_depends[want][1]
+        if soname is not None:
+            print("\n\nAdding %s to provided\n\n" % soname)
+            provided.add(soname)
 
-    for want in want_depends:
-        mg = magic.from_file(want)
-        emul32 = mg.startswith("ELF 32")
-        deps.update(accumulate_dependencies(want, provided, emul32))
+    for want, (emul32, soname, libs, r_paths) in want_depends.items():
+        deps.update(accumulate_dependencies(want, libs, r_paths, provided, emul32))
 
     print("\n\n")
     print("Dependencies")
-    for i in deps:
-        print("  -> %s" % i)
+    sys.stdout.write("".join("  -> %s\n" % i for i in sorted(deps)))
 
 if __name__ == "__main__":
     main()